@@ -1,39 +1,133 @@
 import os
-import pandas as pd
-import numpy as np
-import google.generativeai as genai
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font
-from dotenv import load_dotenv
-load_dotenv()
-
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+import argparse
+import asyncio
+import functools
+import hashlib
+import sqlite3
+from difflib import SequenceMatcher
+
+from sheet_columns import load_two_cols
+
+# pandas, numpy, openpyxl and the Gemini SDK are imported inside the functions that use
+# them, so `--help` and argument errors don't pay their import cost.
+
 EMBED_MODEL = "models/text-embedding-004"
+EMBED_BATCH_SIZE = 100  # API limit on texts per batch request
+EMBED_CONCURRENCY = 8   # Max in-flight embedding requests, to respect rate limits
+EMBED_CACHE_PATH = "embedding_cache.sqlite"
+ARROW_STRING = "string[pyarrow]"
+
+# Character-level similarity cut-offs outside which the embedding call is skipped. They sit
+# well beyond the typical similarity of near-duplicate (~0.82) and unrelated (~0.62) text,
+# so only the clear-cut tails are classified locally.
+MINOR_RATIO = 0.98
+SEVERE_RATIO = 0.2
+
+# Embedding cosine-similarity cut-points and the severity for each band between them
+SEVERITY_THRESHOLDS = (0.55, 0.80)
+SEVERITY_LABELS = ("Severe Change", "Moderate Change", "Minor Wording Change")
+
+
+class EmbeddingCache:
+    """Persistent embedding store keyed by a hash of (model, text).
+
+    Vectors are L2-normalized and stored as int8 with a per-vector scale, a quarter of the
+    float32 size; cosine similarity on them is accurate to about three decimals.
+    """
+
+    def __init__(self, path, model=EMBED_MODEL):
+        self.model = model
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings_int8 (key TEXT PRIMARY KEY, vector BLOB, scale REAL)")
+
+    def key(self, text):
+        return hashlib.blake2b(f"{self.model}\0{text}".encode("utf-8"), digest_size=32).hexdigest()
+
+    @staticmethod
+    def quantize(vector):
+        import numpy as np
+        v = np.asarray(vector, dtype=np.float32)
+        v = v / np.linalg.norm(v)
+        scale = float(np.abs(v).max()) / 127
+        return np.round(v / scale).astype(np.int8), scale
+
+    def get_many(self, texts):
+        """Return {text: vector} for every text already in the cache."""
+        import numpy as np
+
+        keys = {self.key(t): t for t in texts}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500):  # stay under SQLite's bound-parameter limit
+            chunk = key_list[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, vector, scale FROM embeddings_int8 WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for key, blob, scale in rows:
+                found[keys[key]] = np.frombuffer(blob, dtype=np.int8).astype(np.float32) * np.float32(scale)
+        return found
+
+    def put_many(self, items):
+        """Store (text, vector) pairs."""
+        rows = []
+        for t, v in items:
+            q, scale = self.quantize(v)
+            rows.append((self.key(t), q.tobytes(), scale))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings_int8 (key, vector, scale) VALUES (?, ?, ?)",
+            rows
+        )
+        self.conn.commit()
 
-def normalize_columns(df):
-    df.columns = df.columns.str.strip().str.replace('\n', ' ').str.replace('\r', ' ')
-    return df
-
-def find_column(df, possible_names):
-    for col in df.columns:
-        if col.lower().strip() in [name.lower() for name in possible_names]:
-            return col
-    raise KeyError(f"❌ None of these columns found: {possible_names}")
-
-def embed(text: str):
-    """Generate embedding vector using Gemini embeddings."""
-    if text is None or str(text).strip() == "":
-        text = "empty"
-    emb = genai.embed_content(
-        model=EMBED_MODEL,
-        content=str(text),
-        task_type="semantic_similarity"
-    )
-    return np.array(emb["embedding"])
+    def close(self):
+        self.conn.close()
+
+
+@functools.cache
+def _get_genai():
+    """Import and configure the Gemini SDK once, on first use."""
+    import google.generativeai as genai
+    from dotenv import load_dotenv
 
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai
 
-def cosine_similarity(v1, v2):
-    return float(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
+
+async def embed_batch(texts, semaphore, cache):
+    """Return {text: embedding vector} for the given texts.
+
+    Each distinct text is embedded once; cached texts are served from disk and the rest are
+    sent in 100-text batches concurrently.
+    """
+    import numpy as np
+
+    genai = _get_genai()
+    query = {t: str(t) if t is not None and str(t).strip() != "" else "empty" for t in dict.fromkeys(texts)}
+    unique_texts = list(dict.fromkeys(query.values()))
+    vectors = cache.get_many(unique_texts)
+    missing = [t for t in unique_texts if t not in vectors]
+    chunks = [missing[start:start + EMBED_BATCH_SIZE] for start in range(0, len(missing), EMBED_BATCH_SIZE)]
+
+    # Without an explicit client the SDK reuses its process-wide async client, so every
+    # batch already shares one gRPC channel
+    async def embed_chunk(chunk):
+        async with semaphore:
+            return await genai.embed_content_async(
+                model=EMBED_MODEL,
+                content=chunk,
+                task_type="semantic_similarity"
+            )
+
+    results = await asyncio.gather(*(embed_chunk(chunk) for chunk in chunks))
+    fetched = [np.array(v, dtype=np.float32) for emb in results for v in emb["embedding"]]
+    if fetched:
+        cache.put_many(zip(missing, fetched))
+        # Read back the quantized copies so results match later cache-served runs
+        vectors.update(cache.get_many(missing))
+
+    return {t: vectors[q] for t, q in query.items()}
 
 
 def compute_summary(df):
@@ -50,87 +144,107 @@ def compute_summary(df):
     }
 
 
-def semantic_compare(q3_df, q4_df, text_column):
-    q3_df["Code"] = q3_df["Code"].astype(str)
-    q4_df["Code"] = q4_df["Code"].astype(str)
-
-    q4_lookup = {row["Code"]: row for _, row in q4_df.iterrows()}
-    report_rows = []
-
-    for _, q3_row in q3_df.iterrows():
-        code = q3_row["Code"]
-
-        if code not in q4_lookup:
-            report_rows.append({
-                "Code": code,
-                "Status": "Removed in Q4",
-                "Column": text_column,
-                "Q3 Value": q3_row[text_column],
-                "Q4 Value": "",
-                "Similarity": "",
-                "Severity": "Severe Change"
-            })
-            continue
-
-        q4_row = q4_lookup[code]
-
-        old = str(q3_row[text_column]).strip()
-        new = str(q4_row[text_column]).strip()
-
-        if old == new:
-            report_rows.append({
-                "Code": code,
-                "Status": "No Change",
-                "Column": text_column,
-                "Q3 Value": old,
-                "Q4 Value": new,
-                "Similarity": 1.0,
-                "Severity": "No Change"
-            })
-            continue
-
-        old_emb = embed(old)
-        new_emb = embed(new)
-        sim = cosine_similarity(old_emb, new_emb)
-
-        severity = (
-            "Severe Change" if sim < 0.55 else
-            "Moderate Change" if sim < 0.80 else
-            "Minor Wording Change"
-        )
-
-        report_rows.append({
-            "Code": code,
-            "Status": "Modified",
+def quick_severity(old, new):
+    """Classify clear-cut pairs from character similarity alone; returns (sim, severity) or None."""
+    # real_quick_ratio/quick_ratio are upper bounds on ratio, so check them first.
+    sm = SequenceMatcher(None, old, new, autojunk=False)
+    if sm.real_quick_ratio() >= MINOR_RATIO and sm.quick_ratio() >= MINOR_RATIO:
+        sim = sm.ratio()
+        if sim >= MINOR_RATIO:
+            return sim, "Minor Wording Change"
+    elif sm.quick_ratio() <= SEVERE_RATIO:
+        return sm.ratio(), "Severe Change"
+    return None
+
+
+async def semantic_compare(q3_df, q4_df, text_column, semaphore, cache):
+    import numpy as np
+    import pandas as pd
+
+    # Arrow-backed strings: the join, strip and equality below run as pyarrow compute
+    # kernels over packed buffers rather than per-row Python str objects
+    q3_df["Code"] = q3_df["Code"].astype(ARROW_STRING)
+    q4_df["Code"] = q4_df["Code"].astype(ARROW_STRING)
+
+    # One outer join classifies every code; _pos keeps Q3 order with new Q4 codes at the end
+    q3 = q3_df[["Code", text_column]].astype({text_column: ARROW_STRING}).assign(_pos=np.arange(len(q3_df)))
+    q4 = q4_df[["Code", text_column]].astype({text_column: ARROW_STRING})
+    # Matched codes compare against their last Q4 row, as the old dict lookup did
+    merged = q3.merge(q4.drop_duplicates("Code", keep="last"), on="Code", how="outer", suffixes=("_q3", "_q4"), indicator=True)
+    merged = merged.sort_values("_pos", kind="stable").reset_index(drop=True)
+
+    q3_raw = merged[f"{text_column}_q3"]
+    q4_raw = merged[f"{text_column}_q4"]
+    # New codes report their first Q4 row, as the old per-code `.iloc[0]` lookup did
+    q4_first = merged["Code"].map(q4.drop_duplicates("Code", keep="first").set_index("Code")[text_column])
+    old = q3_raw.str.strip()
+    new = q4_raw.str.strip()
+
+    removed_mask = merged["_merge"] == "left_only"
+    new_mask = merged["_merge"] == "right_only"
+    both = merged["_merge"] == "both"
+    eq_mask = both & (old == new).fillna(False).astype(bool)
+    modified_mask = both & ~eq_mask
+
+    def report_slice(mask, status, q3_values, q4_values, similarity, severity):
+        return pd.DataFrame({
+            "Code": merged.loc[mask, "Code"],
+            "Status": status,
             "Column": text_column,
-            "Q3 Value": old,
-            "Q4 Value": new,
-            "Similarity": round(sim, 4),
+            "Q3 Value": q3_values[mask] if isinstance(q3_values, pd.Series) else q3_values,
+            "Q4 Value": q4_values[mask] if isinstance(q4_values, pd.Series) else q4_values,
+            "Similarity": similarity,
             "Severity": severity
-        })
-
-    # New in Q4
-    q3_codes = set(q3_df["Code"])
-    q4_codes = set(q4_df["Code"])
-    new_codes = q4_codes - q3_codes
-
-    for code in new_codes:
-        row = q4_df[q4_df["Code"] == code].iloc[0]
-        report_rows.append({
-            "Code": code,
-            "Status": "New in Q4",
-            "Column": text_column,
-            "Q3 Value": "",
-            "Q4 Value": row[text_column],
-            "Similarity": "",
-            "Severity": "New Entry"
-        })
-
-    return pd.DataFrame(report_rows)
+        }, index=merged.index[mask])
+
+    # Modified rows: local prefilter first, then one batched embedding pass for the rest
+    old_texts = old[modified_mask].tolist()
+    new_texts = new[modified_mask].tolist()
+    sims = np.zeros(len(old_texts))
+    severities = np.empty(len(old_texts), dtype=object)
+
+    pending = []
+    for i, (o, n) in enumerate(zip(old_texts, new_texts)):
+        quick = quick_severity(o, n)
+        if quick is None:
+            pending.append(i)
+        else:
+            sims[i], severities[i] = quick
+
+    if pending:
+        olds = [old_texts[i] for i in pending]
+        news = [new_texts[i] for i in pending]
+        vec_by_text = await embed_batch(olds + news, semaphore, cache)
+
+        # Cosine similarity for all pairs at once: row-wise dot product of L2-normalized matrices
+        A = np.stack([vec_by_text[t] for t in olds]).astype(np.float32)
+        B = np.stack([vec_by_text[t] for t in news]).astype(np.float32)
+        A /= np.linalg.norm(A, axis=1, keepdims=True)
+        B /= np.linalg.norm(B, axis=1, keepdims=True)
+        embed_sims = np.einsum("ij,ij->i", A, B)
+
+        sims[pending] = embed_sims
+        # side="right" keeps the cut-points inclusive on the upper band (0.55 is Moderate)
+        bins = np.searchsorted(SEVERITY_THRESHOLDS, embed_sims, side="right")
+        severities[pending] = np.array(SEVERITY_LABELS, dtype=object)[bins]
+
+    slices = [
+        report_slice(removed_mask, "Removed in Q4", q3_raw, "", "", "Severe Change"),
+        report_slice(eq_mask, "No Change", old, new, 1.0, "No Change"),
+        report_slice(modified_mask, "Modified", old, new, np.round(sims, 4), severities),
+        report_slice(new_mask, "New in Q4", "", q4_first, "", "New Entry"),
+    ]
+    # Empty slices are left out so they don't influence the concatenated dtypes
+    report = pd.concat([part for part in slices if not part.empty] or slices[:1])
+    return report.sort_index().reset_index(drop=True)
 
 
 def apply_conditional_formatting(ws):
-    """Apply color formatting based on Severity values."""
+    """Apply color formatting based on Severity values, as Excel conditional formatting rules."""
+    from openpyxl.formatting.rule import FormulaRule
+    from openpyxl.styles import PatternFill
+    from openpyxl.utils import get_column_letter
+
     colors = {
         "Severe Change": "FFC7CE",     # Red
         "Moderate Change": "FFEB9C",   # Yellow
@@ -139,18 +253,19 @@ def apply_conditional_formatting(ws):
         "No Change": "FFFFFF"          # White
     }
 
-    for row in range(12, ws.max_row + 1):  # Start after summary
-        severity = ws[f"G{row}"].value  # G column = Severity
+    if ws.max_row < 12:
+        return
 
-        if severity in colors:
-            fill = PatternFill(start_color=colors[severity], end_color=colors[severity], fill_type="solid")
-            for col in range(1, ws.max_column + 1):
-                ws.cell(row=row, column=col).fill = fill
+    # One formula rule per severity (G column = Severity) instead of filling each cell
+    cell_range = f"A12:{get_column_letter(ws.max_column)}{ws.max_row}"  # Start after summary
+    for severity, color in colors.items():
+        fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
+        ws.conditional_formatting.add(cell_range, FormulaRule(formula=[f'$G12="{severity}"'], fill=fill))
 
 
 def write_summary(ws, summary):
-    """Insert summary rows at top of sheet."""
-    ws.insert_rows(1, amount=10)
+    """Write summary rows into the 10 rows left free above the report."""
+    from openpyxl.styles import Font
 
     ws["A1"] = "SUMMARY"
     ws["A1"].font = Font(bold=True)
@@ -163,55 +278,59 @@ def write_summary(ws, summary):
 
 
 def process_file(excel_path):
-    print("Reading Excel...")
-    xls = pd.ExcelFile(excel_path)
-
-    wa_q3 = normalize_columns(pd.read_excel(xls, "WA Q3"))
-    wa_q4 = normalize_columns(pd.read_excel(xls, "WA Q4"))
-    md_q3 = normalize_columns(pd.read_excel(xls, "Medicaid Q3"))
-    md_q4 = normalize_columns(pd.read_excel(xls, "Medicaid Q4"))
-
-    wa_q3 = wa_q3.replace(np.nan, "", regex=True)
-    wa_q4 = wa_q4.replace(np.nan, "", regex=True)
-    md_q3 = md_q3.replace(np.nan, "", regex=True)
-    md_q4 = md_q4.replace(np.nan, "", regex=True)
+    import pandas as pd
 
-    # Auto-detect column names
-    wa_col_q3 = find_column(wa_q3, ["Code Notes"])
-    wa_col_q4 = find_column(wa_q4, ["Code Notes"])
-
-    print("Comparing WA...")
-    wa_report = semantic_compare(wa_q3, wa_q4, wa_col_q3)
-
-    md_col_q3 = find_column(md_q3, ["MHI Code Notes"])
-    md_col_q4 = find_column(md_q4, ["MHI Code Notes"])
+    print("Reading Excel...")
 
-    print("Comparing Medicaid...")
-    md_report = semantic_compare(md_q3, md_q4, md_col_q3)
+    # Column names are auto-detected while loading
+    wa_q3, wa_col_q3 = load_two_cols(excel_path, "WA Q3", ["Code Notes"])
+    wa_q4, _ = load_two_cols(excel_path, "WA Q4", ["Code Notes"])
+    md_q3, md_col_q3 = load_two_cols(excel_path, "Medicaid Q3", ["MHI Code Notes"])
+    md_q4, _ = load_two_cols(excel_path, "Medicaid Q4", ["MHI Code Notes"])
+
+    async def main(cache):
+        # Both comparisons share one semaphore so their embedding calls interleave
+        semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        # Progress is printed from inside each task, so it reflects when the comparison runs
+        async def compare(name, q3_df, q4_df, text_column):
+            print(f"Comparing {name}...")
+            report = await semantic_compare(q3_df, q4_df, text_column, semaphore, cache)
+            print(f"✔ {name} compared")
+            return report
+
+        async with asyncio.TaskGroup() as tg:
+            wa_task = tg.create_task(compare("WA", wa_q3, wa_q4, wa_col_q3))
+            md_task = tg.create_task(compare("Medicaid", md_q3, md_q4, md_col_q3))
+        return wa_task.result(), md_task.result()
+
+    cache = EmbeddingCache(EMBED_CACHE_PATH)
+    try:
+        wa_report, md_report = asyncio.run(main(cache))
+    finally:
+        cache.close()
 
     # Replace NaN with empty strings before exporting
-    wa_report = wa_report.replace(np.nan, "", regex=True)
-    md_report = md_report.replace(np.nan, "", regex=True)
+    wa_report = wa_report.fillna("")
+    md_report = md_report.fillna("")
 
+    # Reports, summaries and formatting go into the workbook the writer already loaded,
+    # so the file is parsed and saved only once
     with pd.ExcelWriter(excel_path, mode="a", engine="openpyxl", if_sheet_exists="replace") as writer:
-        wa_report.to_excel(writer, sheet_name="WA Q3 vs WA Q4", index=False)
-        md_report.to_excel(writer, sheet_name="Medicaid Q3 vs Medicaid Q4", index=False)
-
-    wb = load_workbook(excel_path)
+        wa_report.to_excel(writer, sheet_name="WA Q3 vs WA Q4", index=False, startrow=10)
+        md_report.to_excel(writer, sheet_name="Medicaid Q3 vs Medicaid Q4", index=False, startrow=10)
 
-    # Apply summary + formatting to WA sheet
-    ws_wa = wb["WA Q3 vs WA Q4"]
-    summary_wa = compute_summary(wa_report)
-    write_summary(ws_wa, summary_wa)
-    apply_conditional_formatting(ws_wa)
+        # Apply summary + formatting to WA sheet
+        ws_wa = writer.sheets["WA Q3 vs WA Q4"]
+        summary_wa = compute_summary(wa_report)
+        write_summary(ws_wa, summary_wa)
+        apply_conditional_formatting(ws_wa)
 
-    # Apply summary + formatting to Medicaid sheet
-    ws_md = wb["Medicaid Q3 vs Medicaid Q4"]
-    summary_md = compute_summary(md_report)
-    write_summary(ws_md, summary_md)
-    apply_conditional_formatting(ws_md)
-
-    wb.save(excel_path)
+        # Apply summary + formatting to Medicaid sheet
+        ws_md = writer.sheets["Medicaid Q3 vs Medicaid Q4"]
+        summary_md = compute_summary(md_report)
+        write_summary(ws_md, summary_md)
+        apply_conditional_formatting(ws_md)
 
     print("\n🎉 Done!")
     print(f"Sheets updated in: {excel_path}")
@@ -222,4 +341,14 @@ def process_file(excel_path):
 
 
 if __name__ == "__main__":
-    process_file("Authorization Business Matrix 2025 Q3 - WA and Medicaid - Reference.xlsx")
+    parser = argparse.ArgumentParser(
+        description="Semantic Q3 vs Q4 comparison of the WA and Medicaid sheets in an Excel workbook."
+    )
+    parser.add_argument(
+        "excel_path",
+        nargs="?",
+        default="Authorization Business Matrix 2025 Q3 - WA and Medicaid - Reference.xlsx",
+        help="workbook with WA Q3/Q4 and Medicaid Q3/Q4 sheets; report sheets are added to it"
+    )
+    args = parser.parse_args()
+    process_file(args.excel_path)
@@ -0,0 +1,42 @@
+"""Sheet loading shared by code_analysis.py and simple_code_analysis.py."""
+
+
+def load_two_cols(path, sheet, text_names):
+    """Stream only the Code column and the first matching text column of a sheet.
+
+    Returns the frame and the resolved text column name. The workbook is opened read-only,
+    so the other columns, styles and formulas are never loaded.
+    """
+    # Imported on call so code_analysis.py's `--help` stays free of pandas/openpyxl
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet].iter_rows(values_only=True)
+        # Strip whitespace and embedded newlines from header names
+        header = [
+            str(h).strip().replace('\n', ' ').replace('\r', ' ') if h is not None else ""
+            for h in next(rows, ())
+        ]
+        lower = [h.lower() for h in header]
+
+        if "code" not in lower:
+            raise KeyError("❌ None of these columns found: ['Code']")
+        text_idx = next((i for i, h in enumerate(lower) if h in [n.lower() for n in text_names]), None)
+        if text_idx is None:
+            raise KeyError(f"❌ None of these columns found: {text_names}")
+        code_idx = lower.index("code")
+
+        records = []
+        for row in rows:
+            # Without a <dimension> tag read-only rows aren't padded, so trailing empty cells may be missing
+            code = row[code_idx] if len(row) > code_idx else None
+            text = row[text_idx] if len(row) > text_idx else None
+            if code is not None or text is not None:
+                records.append((code, text))
+    finally:
+        wb.close()
+
+    text_column = header[text_idx]
+    return pd.DataFrame.from_records(records, columns=["Code", text_column]).fillna(""), text_column
@@ -1,27 +1,23 @@
 import os
 import pandas as pd
 import numpy as np
-from difflib import SequenceMatcher
-from openpyxl import load_workbook
+from rapidfuzz import fuzz, process
 from openpyxl.styles import PatternFill, Font
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.utils import get_column_letter
 
+from sheet_columns import load_two_cols
 
-def normalize_columns(df):
-    df.columns = df.columns.str.strip().str.replace('\n', ' ').str.replace('\r', ' ')
-    return df
+# Text-similarity cut-points and the severity for each band between them
+SEVERITY_THRESHOLDS = (0.4, 0.75)
+SEVERITY_LABELS = ("Severe Change", "Moderate Change", "Minor Wording Change")
 
 
-def find_column(df, possible_names):
-    for col in df.columns:
-        if col.lower().strip() in [name.lower() for name in possible_names]:
-            return col
-    raise KeyError(f"❌ None of these columns found: {possible_names}")
-
-
-def text_similarity(a, b):
-    if not a and not b:
-        return 1.0
-    return SequenceMatcher(None, str(a), str(b)).ratio()
+def text_similarity(olds, news):
+    """Pairwise similarity (0-1) of olds[i] vs news[i], scored in parallel by rapidfuzz's C++ ratio."""
+    if not olds:
+        return np.array([])
+    return process.cpdist(olds, news, scorer=fuzz.ratio, workers=-1) / 100.0
 
 
 def compute_summary(df):
@@ -41,71 +37,71 @@ def semantic_compare(q3_df, q4_df, text_column):
     q3_df["Code"] = q3_df["Code"].astype(str)
     q4_df["Code"] = q4_df["Code"].astype(str)
 
-    q4_lookup = {row["Code"]: row for _, row in q4_df.iterrows()}
-    report_rows = []
-
-    for _, q3_row in q3_df.iterrows():
-        code = q3_row["Code"]
-
-        if code not in q4_lookup:
-            report_rows.append({
-                "Code": code,
-                "Status": "Removed in Q4",
-                "Column": text_column,
-                "Q3 Value": q3_row[text_column],
-                "Q4 Value": "",
-                "Similarity": "",
-                "Severity": "Severe Change"
-            })
+    # Hashed Code index (last row wins for duplicate codes, as the old dict lookup did)
+    q4_by_code = q4_df.drop_duplicates("Code", keep="last").set_index("Code", drop=False)
+
+    # Stripped text computed once per column; Q4 text aligned to Q3 rows so equality is one array compare
+    q3_raw = q3_df[text_column].to_numpy()
+    q3_text = q3_df[text_column].astype(str).str.strip().to_numpy()
+    q4_text = q4_by_code[text_column].astype(str).str.strip().reindex(q3_df["Code"]).to_numpy()
+    present = q3_df["Code"].isin(q4_by_code.index).to_numpy()
+    unchanged = present & (q3_text == q4_text)
+
+    # Accumulate one list per report column and build the DataFrame once at the end
+    codes, statuses, q3_values, q4_values, similarities, severities = [], [], [], [], [], []
+    modified = []
+
+    for i, code in enumerate(q3_df["Code"]):
+        codes.append(code)
+
+        if not present[i]:
+            statuses.append("Removed in Q4")
+            q3_values.append(q3_raw[i])
+            q4_values.append("")
+            similarities.append("")
+            severities.append("Severe Change")
             continue
 
-        q4_row = q4_lookup[code]
-        old = str(q3_row[text_column]).strip()
-        new = str(q4_row[text_column]).strip()
+        q3_values.append(q3_text[i])
+        q4_values.append(q4_text[i])
 
-        if old == new:
-            similarity = 1.0
-            severity = "No Change"
-            status = "No Change"
+        if unchanged[i]:
+            statuses.append("No Change")
+            similarities.append(1.0)
+            severities.append("No Change")
         else:
-            similarity = text_similarity(old, new)
-
-            if similarity < 0.4:
-                severity = "Severe Change"
-            elif similarity < 0.75:
-                severity = "Moderate Change"
-            else:
-                severity = "Minor Wording Change"
-
-            status = "Modified"
-
-        report_rows.append({
-            "Code": code,
-            "Status": status,
-            "Column": text_column,
-            "Q3 Value": old,
-            "Q4 Value": new,
-            "Similarity": round(similarity, 4),
-            "Severity": severity
-        })
-
-    # Find new codes in Q4
-    q3_codes = set(q3_df["Code"])
-    q4_codes = set(q4_df["Code"])
-
-    for code in q4_codes - q3_codes:
-        q4_row = q4_df[q4_df["Code"] == code].iloc[0]
-        report_rows.append({
-            "Code": code,
-            "Status": "New in Q4",
-            "Column": text_column,
-            "Q3 Value": "",
-            "Q4 Value": q4_row[text_column],
-            "Similarity": "",
-            "Severity": "New Entry"
-        })
-
-    return pd.DataFrame(report_rows)
+            # Scored in one batch after the loop
+            modified.append(i)
+            statuses.append("Modified")
+            similarities.append(None)
+            severities.append(None)
+
+    scores = text_similarity([q3_values[i] for i in modified], [q4_values[i] for i in modified])
+    # side="right" keeps the cut-points inclusive on the upper band (0.4 is Moderate)
+    labels = np.array(SEVERITY_LABELS, dtype=object)[np.searchsorted(SEVERITY_THRESHOLDS, scores, side="right")]
+    for i, similarity, severity in zip(modified, scores, labels):
+        similarities[i] = round(float(similarity), 4)
+        severities[i] = severity
+
+    # Find new codes in Q4 with a single isin filter; each reports its first Q4 row
+    q4_first = q4_df.drop_duplicates("Code", keep="first").set_index("Code", drop=False)
+    new_values = q4_first.loc[~q4_first["Code"].isin(q3_df["Code"]), text_column]
+    codes.extend(new_values.index)
+    statuses.extend(["New in Q4"] * len(new_values))
+    q3_values.extend([""] * len(new_values))
+    q4_values.extend(new_values)
+    similarities.extend([""] * len(new_values))
+    severities.extend(["New Entry"] * len(new_values))
+
+    return pd.DataFrame({
+        "Code": codes,
+        "Status": statuses,
+        "Column": text_column,
+        "Q3 Value": q3_values,
+        "Q4 Value": q4_values,
+        "Similarity": similarities,
+        "Severity": severities
+    })
 
 
 def apply_conditional_formatting(ws):
@@ -117,18 +113,17 @@ def apply_conditional_formatting(ws):
         "No Change": "FFFFFF"
     }
 
-    for row in range(12, ws.max_row + 1):
-        severity = ws[f"G{row}"].value
+    if ws.max_row < 12:
+        return
 
-        if severity in colors:
-            fill = PatternFill(start_color=colors[severity], end_color=colors[severity], fill_type="solid")
-            for col in range(1, ws.max_column + 1):
-                ws.cell(row=row, column=col).fill = fill
+    # One formula rule per severity over the whole report instead of filling each cell
+    cell_range = f"A12:{get_column_letter(ws.max_column)}{ws.max_row}"
+    for severity, color in colors.items():
+        fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
+        ws.conditional_formatting.add(cell_range, FormulaRule(formula=[f'$G12="{severity}"'], fill=fill))
 
 
 def write_summary(ws, summary):
-    ws.insert_rows(1, amount=10)
-
     ws["A1"] = "SUMMARY"
     ws["A1"].font = Font(bold=True)
 
@@ -141,43 +136,31 @@ def write_summary(ws, summary):
 
 def process_file(excel_path):
     print("Reading Excel...")
-    xls = pd.ExcelFile(excel_path)
-
-    wa_q3 = normalize_columns(pd.read_excel(xls, "WA Q3"))
-    wa_q4 = normalize_columns(pd.read_excel(xls, "WA Q4"))
-    md_q3 = normalize_columns(pd.read_excel(xls, "Medicaid Q3"))
-    md_q4 = normalize_columns(pd.read_excel(xls, "Medicaid Q4"))
 
-    wa_q3 = wa_q3.replace(np.nan, "", regex=True)
-    wa_q4 = wa_q4.replace(np.nan, "", regex=True)
-    md_q3 = md_q3.replace(np.nan, "", regex=True)
-    md_q4 = md_q4.replace(np.nan, "", regex=True)
+    wa_q3, wa_col_q3 = load_two_cols(excel_path, "WA Q3", ["Code Notes"])
+    wa_q4, _ = load_two_cols(excel_path, "WA Q4", ["Code Notes"])
+    md_q3, md_col_q3 = load_two_cols(excel_path, "Medicaid Q3", ["MHI Code Notes"])
+    md_q4, _ = load_two_cols(excel_path, "Medicaid Q4", ["MHI Code Notes"])
 
-    wa_col_q3 = find_column(wa_q3, ["Code Notes"])
     wa_report = semantic_compare(wa_q3, wa_q4, wa_col_q3)
-
-    md_col_q3 = find_column(md_q3, ["MHI Code Notes"])
     md_report = semantic_compare(md_q3, md_q4, md_col_q3)
 
-    wa_report = wa_report.replace(np.nan, "")
-    md_report = md_report.replace(np.nan, "")
+    wa_report = wa_report.fillna("")
+    md_report = md_report.fillna("")
 
+    # Write, summarize and format in one pass over the writer's workbook
     with pd.ExcelWriter(excel_path, mode="a", engine="openpyxl", if_sheet_exists="replace") as writer:
-        wa_report.to_excel(writer, sheet_name="WA Q3 vs WA Q4", index=False)
-        md_report.to_excel(writer, sheet_name="Medicaid Q3 vs Medicaid Q4", index=False)
-
-    wb = load_workbook(excel_path)
-
-    ws_wa = wb["WA Q3 vs WA Q4"]
-    ws_md = wb["Medicaid Q3 vs Medicaid Q4"]
+        wa_report.to_excel(writer, sheet_name="WA Q3 vs WA Q4", index=False, startrow=10)
+        md_report.to_excel(writer, sheet_name="Medicaid Q3 vs Medicaid Q4", index=False, startrow=10)
 
-    write_summary(ws_wa, compute_summary(wa_report))
-    write_summary(ws_md, compute_summary(md_report))
+        ws_wa = writer.sheets["WA Q3 vs WA Q4"]
+        ws_md = writer.sheets["Medicaid Q3 vs Medicaid Q4"]
 
-    apply_conditional_formatting(ws_wa)
-    apply_conditional_formatting(ws_md)
+        write_summary(ws_wa, compute_summary(wa_report))
+        write_summary(ws_md, compute_summary(md_report))
 
-    wb.save(excel_path)
+        apply_conditional_formatting(ws_wa)
+        apply_conditional_formatting(ws_md)
 
     print("\n🎉 Done!")
     print("Sheets updated:")